@@ -1,33 +1,244 @@
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 import asyncio
 import subprocess
 import os
+import sys
+import time
+import threading
+import re
+import json
+import math
+import sqlite3
+import logging
+import logging.handlers
+import queue as queue_module
+import contextvars
+import atexit
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import CacheHandler, CacheFileHandler
 from dotenv import load_dotenv
 import yaml
+import numpy as np
 
 # Load environment variables
 load_dotenv()
 
+# Logging: records get queued and written by a background thread, so a slow stdout (docker under log
+# pressure) never stalls the audio thread or the event loop. LOG_LEVEL sets the default level,
+# LOG_LEVELS overrides it per subsystem like "audio=debug,spotify=warning", LOG_FORMAT can be text or json.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+
+# The same warning or error (from the same place) only gets logged once per this many seconds
+LOG_RATE_LIMIT = 30
+
+# guild, command and correlation id of whatever interaction we're handling, added to every log record
+log_context = contextvars.ContextVar('log_context', default={})
+
+
+class ContextFilter(logging.Filter):
+    """adds the current guild/command/correlation id to records."""
+    def filter(self, record):
+        context = log_context.get()
+        for field in ('guild', 'command', 'correlation'):
+            if not hasattr(record, field):
+                setattr(record, field, context.get(field))
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops repeats of the same warning/error within LOG_RATE_LIMIT seconds, and says how many got dropped on the next one through.
+    Info and debug always go through.
+    """
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self._seen = {}
+        self._pruned_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        # keyed on where it was logged from and what it actually says, so different events from one log call still get through
+        key = (record.pathname, record.lineno, record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._seen.get(key, (None, 0))
+            if last is not None and now - last < self.window:
+                self._seen[key] = (last, suppressed + 1)
+                return False
+            # messages carry guild names, error text and so on, so forget ones that are past their window
+            # every so often, or this would keep every message the bot ever logged
+            if now - self._pruned_at > self.window:
+                self._seen = {seen_key: entry for seen_key, entry in self._seen.items() if now - entry[0] < self.window}
+                self._pruned_at = now
+            self._seen[key] = (now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class LogFormatter(logging.Formatter):
+    def __init__(self, json_output):
+        super().__init__()
+        self.json_output = json_output
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('guild', 'command', 'correlation', 'suppressed'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if self.json_output:
+            return json.dumps(entry, default=str)
+        extras = ' '.join(f"{field}={entry[field]}" for field in ('guild', 'command', 'correlation', 'suppressed') if field in entry)
+        line = f"{entry['time']} {entry['level']:<7} {entry['logger']}: {entry['message']}"
+        if extras:
+            line += f" [{extras}]"
+        if 'exception' in entry:
+            line += '\n' + entry['exception']
+        return line
+
+
+def setup_logging():
+    """points the bot's loggers at a queue, with a background listener doing the actual writing."""
+    log_queue = queue_module.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(LogFormatter(LOG_FORMAT == 'json'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger('bot')
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    root.propagate = False
+    for override in LOG_LEVELS.split(','):
+        if '=' in override:
+            subsystem, level = override.split('=', 1)
+            logging.getLogger(f"bot.{subsystem.strip()}").setLevel(level.strip().upper())
+
+    # discord.py logs through the same queue instead of its own stderr handler
+    discord_log = logging.getLogger('discord')
+    discord_log.setLevel(logging.INFO)
+    discord_log.addHandler(queue_handler)
+
+
+setup_logging()
+log = logging.getLogger('bot')
+audio_log = logging.getLogger('bot.audio')
+spotify_log = logging.getLogger('bot.spotify')
+session_log = logging.getLogger('bot.session')
+shard_log = logging.getLogger('bot.shard')
+
 TOKEN = os.getenv("TOKEN")
 
 # Get admin list from environment variable
 admins = [int(admin_id.strip()) for admin_id in os.getenv('BOT_ADMINS', '').split(',') if admin_id.strip()]
 
-# Initialize counter variables
-personpausecounter = 0
-personskipcounter = 0
-personshutdowncounter = 0
-lastperson = None
+# Votes older than this don't count anymore
+VOTE_TTL = 120
+# Share of the people in the vc that need to vote (but always at least 2, unless someone's listening alone)
+VOTE_QUORUM = 0.5
+# After a vote passes, more votes of the same type in that vc are soaked up for this long,
+# so a burst of /skip at a busy event only skips once
+VOTE_COOLDOWN = 10
 
 # Spotify credentials
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI', 'http://localhost:8888/callback')
 
+# Sharding, leave SHARD_COUNT unset to run as one plain process like before.
+# SHARD_IDS picks which shards this process runs (comma separated), the coordinator sets it for its workers.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard_id.strip()) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()]
+WORKER_ID = os.getenv('WORKER_ID', '0')
+STATE_DB = os.getenv('STATE_DB', 'state.db')
+
+# A voice session claim older than this is from a worker that died without cleaning up
+VOICE_CLAIM_TTL = 60
+
+# How often the coordinator looks at the shard load, and how lopsided the workers have to get
+# (busiest worker's guilds / quietest worker's guilds) before it restarts them with a new split
+REBALANCE_INTERVAL = 5 * 60
+REBALANCE_THRESHOLD = 1.25
+
+# Session snapshots older than this are too stale to bother resuming on startup
+SESSION_MAX_AGE = 60 * 60
+
+
+class StateStore:
+    """
+    Tiny json key/value store on sqlite (in WAL mode), so every bot process on the host sees the same state.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self):
+        # sqlite connections can't be shared between threads, so each thread gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO state (key, value, updated) VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+
+    def delete(self, key):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def items(self, prefix):
+        """returns {key: value} for every key starting with prefix."""
+        rows = self._conn().execute("SELECT key, value FROM state WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+
+store = StateStore(STATE_DB)
+
+
+class StoreCacheHandler(CacheHandler):
+    """
+    Keeps the spotify token in the state store so every worker shares it (and refreshes it for the others).
+    Falls back to the old .spotify_cache file so existing setups don't have to log in again.
+    """
+    def get_cached_token(self):
+        token = store.get('spotify_token')
+        if token is None:
+            token = CacheFileHandler(cache_path='.spotify_cache').get_cached_token()
+        return token
+
+    def save_token_to_cache(self, token_info):
+        store.set('spotify_token', token_info)
+
 
 # Initialize Spotify client with OAuth
 sp = None
@@ -51,6 +262,21 @@ def get_queue():
     except:
         return None
 
+# Tracks the bot has added to the spotify queue for each guild that haven't played yet,
+# so a snapshot can put the queue back together after a restart
+enqueued_tracks = {}
+
+def queue_track(guild_id, uri):
+    """adds a track to the spotify queue and remembers it for the guild's session snapshot."""
+    sp.add_to_queue(uri)
+    tail = enqueued_tracks.setdefault(guild_id, [])
+    tail.append(uri)
+    # spotify won't hold a queue this long anyway
+    del tail[:-100]
+    # the up next list on the now playing message is out of date now
+    if guild_id in now_playing:
+        now_playing[guild_id].stale = True
+
 def setup_spotify():
     global sp
     try:
@@ -59,23 +285,208 @@ def setup_spotify():
             client_secret=SPOTIFY_CLIENT_SECRET,
             redirect_uri=SPOTIFY_REDIRECT_URI,
             scope='user-modify-playback-state user-read-playback-state user-read-currently-playing user-library-modify',
-            cache_path='.spotify_cache',
+            cache_handler=StoreCacheHandler(),
             open_browser=False
         ))
-        print("Spotify authentication successful!")
+        spotify_log.info("Spotify authentication successful!")
         return True
     except Exception as e:
-        print(f"Error setting up Spotify: {e}")
+        spotify_log.error("Error setting up Spotify: %s", e)
         return False
 
 # Try to authenticate with Spotify if not already authenticated
-print(setup_spotify())
+setup_spotify()
+
+# Audio quality tiers, picked from the voice channel's bitrate (in bits/s, like discord gives it).
+# There's no point pulling 320kbps from spotify and encoding at full complexity
+# when discord is gonna squash it down to 64kbps anyway.
+# (max channel bitrate, name, librespot kbps, opus kbps, opus complexity, resampler filter size)
+AUDIO_TIERS = [
+    (64000, "low", 96, 64, 5, 8),
+    (96000, "normal", 160, 96, 8, 16),
+    (None, "high", 320, 128, 10, 32),
+]
+
+# If the 1 minute load average per core goes over this, drop down a tier
+HIGH_LOAD_THRESHOLD = 0.75
+
+# Last measured cpu usage (fraction of one core) of librespot + ffmpeg for each tier, used to report how much
+# cpu the lower tiers are saving compared to "high". Kept in the state store, so a bot that mostly plays in
+# low bitrate channels still has a high quality run from some earlier session to compare against.
+pipeline_cpu_usage = {key.split(':', 1)[1]: usage for key, usage in store.items('cpu_usage:').items()}
+
+def get_host_load():
+    """returns the 1 minute load average per cpu core, or 0 if the platform can't tell us."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return 0.0
+
+def pick_audio_profile(channel_bitrate):
+    """picks the audio tier for a voice channel bitrate, stepping down a tier if the host is busy."""
+    index = len(AUDIO_TIERS) - 1
+    for i, tier in enumerate(AUDIO_TIERS):
+        if tier[0] is None or channel_bitrate <= tier[0]:
+            index = i
+            break
+    if get_host_load() > HIGH_LOAD_THRESHOLD and index > 0:
+        index -= 1
+    _, name, librespot_bitrate, opus_bitrate, complexity, filter_size = AUDIO_TIERS[index]
+    # never encode above what the channel can actually carry
+    opus_bitrate = min(opus_bitrate, max(channel_bitrate // 1000, 8))
+    return {
+        'name': name,
+        'librespot_bitrate': librespot_bitrate,
+        'opus_bitrate': opus_bitrate,
+        'complexity': complexity,
+        'filter_size': filter_size,
+    }
+
+def process_cpu_seconds(pid):
+    """returns the user+system cpu time a process has used so far, or None if /proc isn't there."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the process name can have spaces in it, so split after the closing paren
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+# How long the pipeline can go without giving us audio while spotify says it's playing
+# before the watchdog decides it's stuck and swaps in a new one
+STALL_TIMEOUT = 8
+WATCHDOG_INTERVAL = 2
+# The watchdog trusts the playback monitor's last poll for this long (it polls every 10s)
+PLAYBACK_CACHE_TTL = 25
+# If a swap fails, wait this long before trying again, doubling each time up to the max
+SWAP_RETRY_DELAY = 2
+SWAP_RETRY_MAX = 60
+
+# stderr lines from librespot/ffmpeg that mean the pipeline is broken and won't recover by itself.
+# Only the fatal ones, librespot logs errors for stuff like a track that won't load and just skips it.
+STALL_PATTERNS = re.compile(r"panicked|Connection to server closed|Session invalid|Broken pipe|Invalid data found when processing input")
+
+OPUS_SET_COMPLEXITY_REQUEST = 4010
+
+def tune_encoder(encoder, profile):
+    """
+    Applies the profile's opus bitrate and complexity to an encoder. Only call this from the player thread
+    (LibrespotAudio.read does), opus isn't safe to poke at while it's in the middle of encoding a frame.
+    """
+    encoder.set_bitrate(profile['opus_bitrate'])
+    # discord.py doesn't wrap OPUS_SET_COMPLEXITY, so go through the ctl directly if its internals still look
+    # the way we expect, and just keep the default complexity if a discord.py update moved them
+    lib = getattr(discord.opus, '_lib', None)
+    state = getattr(encoder, '_state', None)
+    if lib is None or state is None or not hasattr(lib, 'opus_encoder_ctl'):
+        return
+    lib.opus_encoder_ctl(state, OPUS_SET_COMPLEXITY_REQUEST, profile['complexity'])
+
+# In-process volume, so volume changes are instant instead of a round trip through the spotify api.
+# Volume changes glide this fraction of the way to the target every 20ms frame, which avoids clicks
+VOLUME_RAMP = 0.35
+# Loudness normalization aims for this rms (in dBFS), and won't boost or cut by more than 4x
+NORMALIZE_TARGET_DBFS = -18
+NORMALIZE_MAX_GAIN = 4.0
+# How quickly normalization follows the music, per frame (slow, so it doesn't pump)
+NORMALIZE_SMOOTHING = 0.02
+# Limiter ceiling, as a fraction of full scale, and how fast it lets go afterwards (per frame)
+LIMITER_CEILING = 0.98 * 32767
+LIMITER_RELEASE = 1.02
+
+class GainStage:
+    """
+    Volume, loudness normalization and a peak limiter for s16le stereo frames, all done with numpy on the whole frame.
+    """
+    def __init__(self, volume=1.0, normalize=False):
+        self.volume = volume
+        self.normalize = normalize
+        self._gain = volume
+        self._rms = None
+        self._limiter = 1.0
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def set_normalize(self, normalize):
+        self.normalize = normalize
+        self._rms = None
+
+    def _target_gain(self, samples):
+        if not self.normalize:
+            return self.volume
+        rms = float(np.sqrt(np.mean(np.square(samples))))
+        # don't let quiet bits between tracks drag the average around
+        if rms > 100:
+            self._rms = rms if self._rms is None else self._rms + (rms - self._rms) * NORMALIZE_SMOOTHING
+        if self._rms is None:
+            return self.volume
+        target = 32767 * 10 ** (NORMALIZE_TARGET_DBFS / 20)
+        return self.volume * min(max(target / self._rms, 1 / NORMALIZE_MAX_GAIN), NORMALIZE_MAX_GAIN)
+
+    def process(self, data):
+        # nothing to do at 100% with normalization off, which is the common case
+        if not self.normalize and self.volume == 1.0 and self._gain == 1.0 and self._limiter == 1.0:
+            return data
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32).reshape(-1, 2)
+        target = self._target_gain(samples)
+        start = self._gain
+        end = start + (target - start) * VOLUME_RAMP
+        if abs(target - end) < 0.001:
+            end = target
+
+        # ramp across the frame instead of jumping at the frame boundary
+        gains = np.linspace(start * self._limiter, end * self._limiter, len(samples), dtype=np.float32)
+        samples *= gains[:, None]
+        peak = float(np.max(np.abs(samples))) if len(samples) else 0.0
+        if peak > LIMITER_CEILING:
+            reduction = LIMITER_CEILING / peak
+            samples *= reduction
+            self._limiter *= reduction
+        else:
+            self._limiter = min(1.0, self._limiter * LIMITER_RELEASE)
+        self._gain = end
+        return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+# one gain stage per guild, so the volume sticks around when the pipeline gets restarted or hot swapped
+guild_gain = {}
+
+def get_gain_stage(guild_id):
+    """returns the guild's gain stage, starting it at the volume saved in the state store."""
+    if guild_id not in guild_gain:
+        settings = store.get(f"volume:{guild_id}", {'volume': 1.0, 'normalize': False})
+        guild_gain[guild_id] = GainStage(settings['volume'], settings['normalize'])
+    return guild_gain[guild_id]
 
 class LibrespotAudio(discord.AudioSource):
-    def __init__(self):
+    def __init__(self, profile=None, guild_id=None):
         self.librespot_process = None
         self.ffmpeg_process = None
         self._started = False
+        self.profile = profile or pick_audio_profile(128000)
+        # only used for logging, the player thread doesn't know which guild it's playing for
+        self.guild_id = guild_id
+        self.gain = get_gain_stage(guild_id) if guild_id is not None else GainStage()
+        self._started_at = None
+        self.last_data_at = None
+        self.failure = None
+        # (voice client, profile) waiting to be applied to the encoder from the player thread
+        self._pending_tuning = None
+
+    def request_tuning(self, vc, profile):
+        """queues up encoder settings for the player thread to apply before its next frame."""
+        self._pending_tuning = (vc, profile)
+
+    def _apply_tuning(self):
+        vc, profile = self._pending_tuning
+        encoder = getattr(vc, 'encoder', None)
+        if encoder is None:
+            return
+        self._pending_tuning = None
+        try:
+            tune_encoder(encoder, profile)
+        except Exception as e:
+            audio_log.error("Error tuning opus encoder: %s", e, extra={'guild': self.guild_id})
 
     async def start(self):
         if self._started:
@@ -87,45 +498,61 @@ class LibrespotAudio(discord.AudioSource):
                 ['librespot',
                 '--name', 'Discord Bot',
                 '--backend', 'pipe',
-                '--bitrate', '320'],
+                '--bitrate', str(self.profile['librespot_bitrate']),
+                # volume is handled by our gain stage, so librespot always gives us full scale audio
+                '--initial-volume', '100',
+                '--volume-ctrl', 'fixed'],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
-            
+
             # Start ffmpeg process that reads from librespot and converts audio
             # Input: s16le, 2 channels, 44100 Hz from librespot
-            # Output: f32le, 2 channels, 48000 Hz
+            # Output: s16le, 2 channels, 48000 Hz (discord needs this no matter the tier,
+            # but the resampler filter gets cheaper on the lower tiers)
             self.ffmpeg_process = subprocess.Popen(
                 ['ffmpeg',
                 '-f', 's16le',
                 '-ac', '2',
                 '-ar', '44100',
+                '-nostats',
+                '-loglevel', 'error',
                 '-re',
                 '-i', 'pipe:0',
                 '-map', '0:a:0',
+                '-af', f"aresample=48000:filter_size={self.profile['filter_size']}",
                 '-c:a:0', 'pcm_s16le',
                 '-ar', '48000',
                 '-ac', '2',
+                '-threads', '1',
                 '-f', 's16le',
                 '-'],
                 stdin=self.librespot_process.stdout,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
-            
+
             # Close the stdout of librespot in the parent process so that
             # only ffmpeg reads from it
             if self.librespot_process.stdout:
                 self.librespot_process.stdout.close()
-            
+
             self._started = True
-            print("Librespot and ffmpeg started successfully")
+            self._started_at = time.monotonic()
+            self.last_data_at = self._started_at
+            self.failure = None
+            for name, process in (("librespot", self.librespot_process), ("ffmpeg", self.ffmpeg_process)):
+                threading.Thread(target=self._watch_stderr, args=(name, process), daemon=True).start()
+            audio_log.info("Librespot and ffmpeg started successfully (%s quality, %skbps)", self.profile['name'], self.profile['librespot_bitrate'], extra={'guild': self.guild_id})
         except Exception as e:
-            print(f"Error starting librespot/ffmpeg: {e}")
+            audio_log.error("Error starting librespot/ffmpeg: %s", e, extra={'guild': self.guild_id})
             self.cleanup()
             raise
 
     def read(self, blocksize):
+        # the player thread encodes whatever we return right after this, so nothing else is using the encoder now
+        if self._pending_tuning:
+            self._apply_tuning()
         if not self.ffmpeg_process or self.ffmpeg_process.stdout is None:
             return b'\x00' * blocksize
         
@@ -135,18 +562,73 @@ class LibrespotAudio(discord.AudioSource):
             if not data:
                 # Return silence if no data
                 return b'\x00' * blocksize
+            self.last_data_at = time.monotonic()
             
             # If we got less data than requested, pad with silence
             if len(data) < blocksize:
                 data += b'\x00' * (blocksize - len(data))
             
-            return data
+            return self.gain.process(data)
             
         except Exception as e:
-            print(f"Error reading audio: {e}")
+            audio_log.error("Error reading audio: %s", e, extra={'guild': self.guild_id})
             return b'\x00' * blocksize
 
+    def _watch_stderr(self, name, process):
+        # Keeps the stderr pipe drained (a full pipe blocks the child, which looks exactly like a hang)
+        # and remembers the first line that means the pipeline is broken
+        try:
+            for line in iter(process.stderr.readline, b''):
+                line = line.decode(errors='replace').strip()
+                if self.failure is None and STALL_PATTERNS.search(line):
+                    self.failure = f"{name}: {line}"
+        except (OSError, ValueError):
+            pass
+
+    def check_health(self, is_playing):
+        """returns why the pipeline looks dead or stuck, or None if it seems fine."""
+        # still attached but not running means a swap died halfway through
+        if not self._started:
+            return "pipeline isn't running"
+        for name, process in (("librespot", self.librespot_process), ("ffmpeg", self.ffmpeg_process)):
+            if process and process.poll() is not None:
+                return f"{name} exited with code {process.returncode}"
+        if self.failure:
+            return self.failure
+        if is_playing and self.last_data_at and time.monotonic() - self.last_data_at > STALL_TIMEOUT:
+            return f"no audio for {time.monotonic() - self.last_data_at:.0f}s while spotify is playing"
+        return None
+
+    def report_cpu_usage(self):
+        """logs how much cpu this pipeline used, and how much that saved compared to the high tier."""
+        if not self._started_at:
+            return
+        elapsed = time.monotonic() - self._started_at
+        if elapsed < 1:
+            return
+        used = 0.0
+        for process in (self.librespot_process, self.ffmpeg_process):
+            if process:
+                seconds = process_cpu_seconds(process.pid)
+                if seconds is None:
+                    return
+                used += seconds
+        usage = used / elapsed
+        pipeline_cpu_usage[self.profile['name']] = usage
+        # cleanup gets called from all over (the event loop included), don't make it wait on sqlite
+        threading.Thread(target=store.set, args=(f"cpu_usage:{self.profile['name']}", usage), daemon=True).start()
+        message = f"Audio pipeline used {usage * 100:.1f}% of a core over {elapsed:.0f}s ({self.profile['name']} quality)"
+        baseline = pipeline_cpu_usage.get("high")
+        if baseline and self.profile['name'] != "high":
+            message += f", saving about {(baseline - usage) * 100:.1f}% of a core compared to high quality"
+        elif self.profile['name'] != "high":
+            message += ", no high quality run measured yet to compare against"
+        audio_log.info(message, extra={'guild': self.guild_id})
+
     def cleanup(self):
+        self.report_cpu_usage()
+        self._started_at = None
+
         # Stop ffmpeg process first
         if self.ffmpeg_process:
             try:
@@ -180,36 +662,441 @@ class LibrespotAudio(discord.AudioSource):
         self.cleanup()
 
 
+class LoggingCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # runs in the same task as the command, so everything the command logs gets tagged with this
+        log_context.set({
+            'guild': interaction.guild_id,
+            'command': interaction.command.name if interaction.command else None,
+            'correlation': interaction.id,
+        })
+        return True
+
+
+class VoteEngine:
+    """
+    Skip/pause/shutdown votes, kept per voice channel and vote type. Listener counts come from voice state events,
+    so checking quorum never needs an api call.
+    """
+    def __init__(self, ttl, quorum, cooldown):
+        self.ttl = ttl
+        self.quorum = quorum
+        self.cooldown = cooldown
+        # channel id -> ids of the (non bot) members in it
+        self.listeners = {}
+        # (channel id, vote type) -> {user id: when they voted}
+        self.votes = {}
+        # (channel id, vote type) -> when that vote last passed
+        self.passed = {}
+
+    def track_channel(self, channel):
+        """seeds the listener list from the member cache, for when we join a channel."""
+        self.listeners[channel.id] = {member.id for member in channel.members if not member.bot}
+
+    def member_moved(self, member, before, after):
+        # mutes and deafens come through here too, only care about actual moves
+        if member.bot or before == after:
+            return
+        if before and before.id in self.listeners:
+            self.listeners[before.id].discard(member.id)
+            # people who left don't get a say anymore
+            for (channel_id, _), ballots in self.votes.items():
+                if channel_id == before.id:
+                    ballots.pop(member.id, None)
+        if after and after.id in self.listeners:
+            self.listeners[after.id].add(member.id)
+
+    def forget_channel(self, channel_id):
+        self.listeners.pop(channel_id, None)
+        for key in [key for key in self.votes if key[0] == channel_id]:
+            del self.votes[key]
+        for key in [key for key in self.passed if key[0] == channel_id]:
+            del self.passed[key]
+
+    def needed(self, channel_id):
+        listeners = len(self.listeners.get(channel_id, ()))
+        if listeners == 0:
+            # we don't know who's there, fall back to the old two person rule
+            return 2
+        return max(min(2, listeners), math.ceil(listeners * self.quorum))
+
+    def cast(self, channel_id, kind, user_id):
+        """
+        Records a vote, returns ("passed" | "voted" | "already" | "done", votes so far, votes needed).
+        A vote that passes clears that channel's votes of the same type, and votes that come in
+        right after it passed come back as "done" instead of starting a new vote.
+        """
+        now = time.monotonic()
+        passed_at = self.passed.get((channel_id, kind))
+        if passed_at is not None and now - passed_at < self.cooldown:
+            return "done", 0, self.needed(channel_id)
+        ballots = self.votes.setdefault((channel_id, kind), {})
+        for voter, voted_at in list(ballots.items()):
+            if now - voted_at > self.ttl:
+                del ballots[voter]
+        needed = self.needed(channel_id)
+        if user_id in ballots:
+            return "already", len(ballots), needed
+        ballots[user_id] = now
+        if len(ballots) >= needed:
+            del self.votes[(channel_id, kind)]
+            self.passed[(channel_id, kind)] = now
+            return "passed", needed, needed
+        return "voted", len(ballots), needed
+
+    def reset(self, channel_id, kind):
+        """clears the vote for an admin override, which counts as it passing."""
+        self.votes.pop((channel_id, kind), None)
+        self.passed[(channel_id, kind)] = time.monotonic()
+
+
+votes = VoteEngine(VOTE_TTL, VOTE_QUORUM, VOTE_COOLDOWN)
+
+
+def vote_message(kind, count, needed):
+    remaining = needed - count
+    return f"voted to {kind} ({count}/{needed}), {remaining} more {'person needs' if remaining == 1 else 'people need'} to also run /{kind}."
+
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None, tree_cls=LoggingCommandTree)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=LoggingCommandTree)
 tree = bot.tree
 
 async def is_bot_in_any_voice_channel(bot: commands.Bot) -> bool:
-    return any(vc.is_connected() for vc in bot.voice_clients)
+    if any(vc.is_connected() for vc in bot.voice_clients):
+        return True
+    # there's only one spotify account and one librespot device to go around, so check the other workers too
+    claim = store.get('voice_session')
+    return claim_is_live(claim)
+
+def claim_is_live(claim, guild_id=None):
+    """
+    True if another worker is playing. Our own worker's claim with no vc connected is left over from
+    before a crash or restart, and a claim for guild_id is ours to take over.
+    """
+    if not claim or time.time() - claim['heartbeat'] >= VOICE_CLAIM_TTL:
+        return False
+    return claim['worker'] != WORKER_ID and claim['guild_id'] != guild_id
+
+def claim_voice_session(guild_id):
+    """marks this worker as the one playing, so the other workers don't try to join a vc too."""
+    store.set('voice_session', {'guild_id': guild_id, 'worker': WORKER_ID, 'heartbeat': time.time()})
+
+def release_voice_session(guild_id):
+    claim = store.get('voice_session')
+    if claim and claim['guild_id'] == guild_id:
+        store.delete('voice_session')
+
+
+# guild id -> (when, playback) from the monitor's last poll, so nothing else has to ask spotify again
+latest_playback = {}
+
+def playing_on_librespot(playback):
+    """True if the playback is playing on our librespot device (not someone's phone or desktop app)."""
+    return bool(playback and playback.get('is_playing') and playback.get('device') and playback['device']['name'] == "Discord Bot")
 
 
 async def monitor_playback_and_disconnect(vc: discord.VoiceClient, check_interval: int = 10):
     """
     Periodically checks if Spotify is playing. If not, disconnects the bot from the voice channel.
     """
+    # this task was started from whatever command joined the vc, don't tag the whole session's logs with it
+    log_context.set({'guild': vc.guild.id})
     while vc.is_connected():
         await asyncio.sleep(check_interval)
+        if vc.is_connected():
+            await asyncio.to_thread(claim_voice_session, vc.guild.id)
         try:
             playback = sp.current_playback()
+            latest_playback[vc.guild.id] = (time.monotonic(), playback)
+            if vc.is_connected():
+                # a snapshot or status message going wrong is this guild's problem, not a reason to shut down
+                try:
+                    await save_session(vc, playback)
+                    get_now_playing(vc.guild.id).refresh(playback)
+                except Exception as e:
+                    session_log.error("Error saving session: %s", e, extra={'guild': vc.guild.id})
             if not playback or not playback.get('is_playing'):
-                print("Spotify is not playing. Disconnecting from voice channel.")
+                spotify_log.debug("Spotify is not playing.")
                 #if vc.source:
                 #    vc.source.cleanup()
                 #await vc.disconnect()
                 #await shutdown_bot()
                 #break
         except Exception as e:
-            print(f"Error in playback monitor: {e}")
+            spotify_log.error("Error in playback monitor: %s", e)
             await shutdown_bot()
             break
 
 
+async def save_session(vc: discord.VoiceClient, playback):
+    """
+    Snapshots the guild's session into the state store, reusing the playback the monitor already fetched.
+    The sqlite write happens on a worker thread, so neither the event loop nor the audio thread wait on disk.
+    """
+    guild_id = vc.guild.id
+    tail = enqueued_tracks.get(guild_id, [])
+    track_uri = None
+    if playback and playback.get('item'):
+        track_uri = playback['item']['uri']
+        # drop everything we queued up to (and including) what's playing now, it's been played
+        if track_uri in tail:
+            del tail[:tail.index(track_uri) + 1]
+    session = {
+        'channel_id': vc.channel.id,
+        # only our own device, transferring to someone's phone on startup would be rude
+        'device_id': playback['device']['id'] if playback and playback.get('device') and playback['device']['name'] == "Discord Bot" else None,
+        'track_uri': track_uri,
+        'position_ms': playback.get('progress_ms') if playback else None,
+        'is_playing': bool(playback and playback.get('is_playing')),
+        'queue': list(tail),
+        'saved_at': time.time(),
+    }
+    await asyncio.to_thread(store.set, f"session:{guild_id}", session)
+
+
+def forget_session(guild_id):
+    """drops the guild's snapshot, for when people actually wanted the bot gone."""
+    enqueued_tracks.pop(guild_id, None)
+    store.delete(f"session:{guild_id}")
+
+
+async def restore_session(guild_id, session):
+    """
+    Rejoins the snapshotted vc and gets spotify playing where it left off.
+    """
+    channel = bot.get_channel(session['channel_id'])
+    if channel is None or channel.guild.voice_client:
+        return
+    if any(vc.is_connected() for vc in bot.voice_clients):
+        return
+    # a claim for this guild, or from this worker, is just our own from before the restart
+    if claim_is_live(store.get('voice_session'), guild_id):
+        return
+    # claim it before connecting, so nothing else starts a librespot while we're still joining
+    await asyncio.to_thread(claim_voice_session, guild_id)
+    vc = await channel.connect()
+    await start_audio(vc)
+    enqueued_tracks[guild_id] = list(session['queue'])
+
+    # librespot's device id comes from its name, so the saved one is usually still good
+    transferred = False
+    if session['device_id']:
+        await asyncio.sleep(2)
+        try:
+            sp.transfer_playback(device_id=session['device_id'], force_play=True)
+            transferred = True
+        except Exception as e:
+            session_log.warning("Saved device didn't work, looking for librespot again: %s", e)
+    if not transferred and not await transfer_to_librespot(force_play=True):
+        session_log.error("Couldn't find librespot to resume the session in %s", channel.guild.name, extra={'guild': guild_id})
+        return
+
+    # if spotify moved on while we were down (or lost our track), put our track and queue back
+    playback = sp.current_playback()
+    if session['track_uri'] and (not playback or not playback.get('item') or playback['item']['uri'] != session['track_uri']):
+        sp.start_playback(uris=[session['track_uri']] + session['queue'], position_ms=session['position_ms'] or 0)
+    session_log.info("Resumed session in %s", channel.guild.name, extra={'guild': guild_id})
+
+
+async def restore_sessions():
+    """
+    Resumes the most recent snapshotted session. There's one spotify account, so only one session can play;
+    every worker picks the same newest one, and only the worker that owns its guild resumes it.
+    Our other snapshots get dropped, they'd never get to play anyway.
+    """
+    sessions = await asyncio.to_thread(store.items, "session:")
+    newest = None
+    for key, session in sessions.items():
+        if not session['is_playing'] or time.time() - session['saved_at'] > SESSION_MAX_AGE:
+            continue
+        if newest is None or session['saved_at'] > newest[1]['saved_at']:
+            newest = (int(key.split(':', 1)[1]), session)
+    for key in sessions:
+        guild_id = int(key.split(':', 1)[1])
+        if bot.get_guild(guild_id) and (newest is None or guild_id != newest[0]):
+            await asyncio.to_thread(store.delete, key)
+    if newest is None or not bot.get_guild(newest[0]):
+        return
+    try:
+        await restore_session(*newest)
+    except Exception as e:
+        session_log.error("Error resuming session: %s", e, extra={'guild': newest[0]})
+
+
+# Discord lets us edit a message about 5 times every 5 seconds, stay well under that
+NOW_PLAYING_EDIT_INTERVAL = 5
+
+
+def render_queue(tracks):
+    return f"""Queue (first song is currently playing):
+{yaml.dump(tracks)}"""
+
+
+class NowPlaying:
+    """
+    A guild's live now playing message. It's rendered once per track (or when we queue something), and edits
+    get coalesced so there's at most one every NOW_PLAYING_EDIT_INTERVAL seconds, no matter how often it changes.
+    """
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.track_uri = None
+        self.text = None
+        self.stale = True
+        self.channel = None
+        self.message = None
+        self._last_edit = 0
+        self._edit_task = None
+
+    def refresh(self, playback):
+        """re-renders from the playback the monitor already fetched, only asking spotify for the queue when the track changed."""
+        track_uri = playback['item']['uri'] if playback and playback.get('item') else None
+        if track_uri == self.track_uri and not self.stale:
+            return
+        self.track_uri = track_uri
+        if self.channel is None:
+            # nobody's got a live message up, the next /queue renders it
+            self.stale = True
+            return
+        self.stale = False
+        tracks = get_queue() if track_uri else None
+        text = render_queue(tracks) if tracks else "nothing's playing right now."
+        if text != self.text:
+            self.text = text
+            self.schedule_edit()
+
+    def attach(self, channel):
+        """picks the channel the live message goes in (the first one someone asked in). Render it before attaching."""
+        if self.channel is None:
+            self.channel = channel
+            self.schedule_edit()
+
+    def schedule_edit(self):
+        # an edit is already waiting, it'll pick up the latest text when it goes
+        if self.channel is None or self.text is None or (self._edit_task and not self._edit_task.done()):
+            return
+        self._edit_task = asyncio.create_task(self._edit())
+
+    async def _edit(self):
+        log_context.set({'guild': self.guild_id})
+        wait = self._last_edit + NOW_PLAYING_EDIT_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_edit = time.monotonic()
+        try:
+            if self.message is None:
+                self.message = await self.channel.send(self.text)
+            else:
+                await self.message.edit(content=self.text)
+        except discord.NotFound:
+            # someone deleted it, post a new one next time
+            self.message = None
+        except discord.HTTPException as e:
+            log.error("Error updating now playing message: %s", e, extra={'guild': self.guild_id})
+
+
+now_playing = {}
+
+def get_now_playing(guild_id):
+    if guild_id not in now_playing:
+        now_playing[guild_id] = NowPlaying(guild_id)
+    return now_playing[guild_id]
+
+
+async def start_audio(vc: discord.VoiceClient):
+    """
+    Starts librespot at a quality that suits the voice channel, plays it into the vc and starts the playback monitor.
+    """
+    await asyncio.to_thread(claim_voice_session, vc.guild.id)
+    profile = pick_audio_profile(vc.channel.bitrate)
+    librespot = LibrespotAudio(profile, vc.guild.id)
+    await librespot.start()
+    source = discord.PCMAudio(
+        librespot
+    )
+    vc.play(source, bitrate=profile['opus_bitrate'])
+    librespot.request_tuning(vc, profile)
+    asyncio.create_task(monitor_playback_and_disconnect(vc))
+    asyncio.create_task(watch_audio_pipeline(vc))
+    return librespot
+
+
+async def transfer_to_librespot(force_play=True, attempts=10):
+    """
+    Waits for the "Discord Bot" device to show up on spotify and moves playback to it. Returns True if it worked.
+    """
+    for _ in range(attempts):
+        try:
+            devices = sp.devices()
+            for d in devices['devices']:
+                if d['name'] == "Discord Bot":
+                    sp.transfer_playback(device_id=d['id'], force_play=force_play)
+                    return True
+        except Exception as e:
+            spotify_log.error("Error transferring playback: %s", e)
+        await asyncio.sleep(1)
+    return False
+
+
+async def hot_swap_audio(vc: discord.VoiceClient, reason: str, profile=None, force_play=True):
+    """
+    Replaces the librespot/ffmpeg pipeline (a dead or stuck one, or one at the wrong quality) with a fresh one
+    without leaving the voice channel.
+    """
+    audio_log.warning("Swapping in a new audio pipeline in %s (%s)", vc.guild.name, reason, extra={'guild': vc.guild.id})
+    old = getattr(vc.source, 'stream', None)
+    if isinstance(old, LibrespotAudio):
+        # kill the old one first, so a blocked read in the player thread gets unstuck
+        # and there's only ever one "Discord Bot" device for spotify to pick
+        old.cleanup()
+    librespot = LibrespotAudio(profile or pick_audio_profile(vc.channel.bitrate), vc.guild.id)
+    await librespot.start()
+    source = discord.PCMAudio(
+        librespot
+    )
+    if vc.is_playing() or vc.is_paused():
+        vc.source = source
+    else:
+        vc.play(source, bitrate=librespot.profile['opus_bitrate'])
+    librespot.request_tuning(vc, librespot.profile)
+    if await transfer_to_librespot(force_play=force_play):
+        audio_log.info("Audio pipeline in %s recovered", vc.guild.name, extra={'guild': vc.guild.id})
+    else:
+        audio_log.error("Audio pipeline in %s restarted, but spotify never saw the new device", vc.guild.name, extra={'guild': vc.guild.id})
+    return librespot
+
+
+async def watch_audio_pipeline(vc: discord.VoiceClient):
+    """
+    Watches the vc's librespot/ffmpeg pipeline and hot swaps it if it dies or stops giving us audio.
+    """
+    log_context.set({'guild': vc.guild.id})
+    retry_delay = SWAP_RETRY_DELAY
+    while vc.is_connected():
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        librespot = getattr(vc.source, 'stream', None)
+        if not isinstance(librespot, LibrespotAudio):
+            continue
+        # uses what the playback monitor last saw instead of polling spotify ourselves,
+        # a paused or finished vc is quiet all the time and would have us asking every couple of seconds
+        quiet = librespot.last_data_at and time.monotonic() - librespot.last_data_at > STALL_TIMEOUT
+        polled_at, playback = latest_playback.get(vc.guild.id, (0, None))
+        fresh = time.monotonic() - polled_at < PLAYBACK_CACHE_TTL
+        reason = librespot.check_health(bool(quiet and fresh and playing_on_librespot(playback)))
+        if reason:
+            try:
+                await hot_swap_audio(vc, reason)
+                retry_delay = SWAP_RETRY_DELAY
+            except Exception as e:
+                audio_log.error("Error swapping audio pipeline, trying again in %ss: %s", retry_delay, e, extra={'guild': vc.guild.id})
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, SWAP_RETRY_MAX)
+
+
 @tree.command(name="leave", description="Leave the voice channel", )
 async def leave(interaction: discord.Interaction):
     if not interaction.user.voice:
@@ -220,6 +1107,7 @@ async def leave(interaction: discord.Interaction):
         if interaction.guild.voice_client.source:
             interaction.guild.voice_client.source.cleanup()
         await interaction.guild.voice_client.disconnect()
+        forget_session(interaction.guild.id)
         await interaction.response.send_message("Disconnected.", ephemeral=True)
         #await shutdown_bot()
     else:
@@ -236,7 +1124,19 @@ async def is_spotify_playing():
             return True
         return False
     except Exception as e:
-        print(f"Error checking Spotify playback status: {e}")
+        spotify_log.error("Error checking Spotify playback status: %s", e)
+        return False
+
+
+async def is_librespot_playing():
+    """
+    Returns True if Spotify is playing on our librespot device (not someone's phone or desktop app).
+    """
+    try:
+        playback = sp.current_playback()
+        return playing_on_librespot(playback)
+    except Exception as e:
+        spotify_log.error("Error checking Spotify playback status: %s", e)
         return False
 
 
@@ -258,27 +1158,21 @@ async def play(interaction: discord.Interaction, query: str, play_type: str = "t
         channel = interaction.user.voice.channel
         vc = await channel.connect()
 
-        librespot = LibrespotAudio()
-        await librespot.start()
-        source = discord.PCMAudio(
-            librespot
-        )
-        vc.play(source)
-        asyncio.create_task(monitor_playback_and_disconnect(vc))
+        await start_audio(vc)
 
         await interaction.response.send_message("firing up librespot...", ephemeral=True)
         device_found = False
         while not device_found:
             devices = sp.devices()
             for d in devices['devices']:
-                print(f"{d['name']}: {d['id']}")
+                spotify_log.debug("Found device %s: %s", d['name'], d['id'])
                 if "Discord Bot" in d['name']:
                     try:
                         sp.transfer_playback(device_id=d['id'], force_play=False)
                         device_found = True
                         await asyncio.sleep(2)
                     except Exception as e:
-                        print(e)
+                        spotify_log.error("Error transferring playback: %s", e)
                         pass
                 else:
                     await asyncio.sleep(2)
@@ -315,19 +1209,18 @@ async def play(interaction: discord.Interaction, query: str, play_type: str = "t
                     chunk = track_ids[i:i + chunk_size]
                     sp.current_user_saved_tracks_add(tracks=chunk)
             except Exception as e:
-                print(f"Error adding album tracks to liked songs: {e}")
+                spotify_log.error("Error adding album tracks to liked songs: %s", e)
 
             if await is_spotify_playing():
                 # Add all tracks to queue
                 for uri in track_uris:
-                    sp.add_to_queue(uri)
+                    queue_track(interaction.guild.id, uri)
                 await interaction.edit_original_response(content=f"Added album to queue: {album['name']} by {album['artists'][0]['name']}\n({len(track_uris)} tracks)")
             else:
                 # Start playback with first track and queue the rest
                 sp.start_playback(uris=[track_uris[0]])
-                sp.volume(100)
                 for uri in track_uris[1:]:
-                    sp.add_to_queue(uri)
+                    queue_track(interaction.guild.id, uri)
                 await interaction.edit_original_response(content=f"Now playing album: {album['name']} by {album['artists'][0]['name']}\n({len(track_uris)} tracks)")
 
         else:  # Default to track
@@ -346,11 +1239,11 @@ async def play(interaction: discord.Interaction, query: str, play_type: str = "t
             try:
                 sp.current_user_saved_tracks_add(tracks=[track['id']])
             except Exception as e:
-                print(f"Error adding track to liked songs: {e}")
+                spotify_log.error("Error adding track to liked songs: %s", e)
 
             if await is_spotify_playing():
                 # Add to queue
-                sp.add_to_queue(track_uri)
+                queue_track(interaction.guild.id, track_uri)
                 await interaction.edit_original_response(content=f"added {track_name} by {artist_name} to the queue.")
             else:
                 # Start playback
@@ -359,13 +1252,12 @@ async def play(interaction: discord.Interaction, query: str, play_type: str = "t
                 sp.previous_track()
 
     except Exception as e:
-        print(e)
+        log.error("Error playing or queuing: %s", e)
         await interaction.edit_original_response(content=f"Error playing or queuing: {str(e)}")
 
 
 @tree.command(name="pause", description="Pause Spotify playback", )
 async def pause(interaction: discord.Interaction):
-    global personpausecounter, lastperson
     if not interaction.user.voice:
         await interaction.response.send_message("brotha join a vc first", ephemeral=True)
         return
@@ -374,28 +1266,30 @@ async def pause(interaction: discord.Interaction):
         return
     if interaction.guild.voice_client:
 
-        match personpausecounter:
-            case _ if interaction.user.id in admins:
-                personpausecounter = 0
-                await interaction.response.send_message("[admin override applied] pausing the bot, use /resume to keep playing the queue")
-            case _ if personpausecounter == 0:
-                personpausecounter += 1
-                lastperson = interaction.user.id
-                await interaction.response.send_message("voted to pause, but 1 more person needs to also run /pause.")
-                return
-            case _ if personpausecounter == 1 and lastperson != interaction.user.id:
-                personpausecounter = 0
-                lastperson = None
-                await interaction.response.send_message("pausing the bot, use /resume to keep playing the queue")
-            case _ if personpausecounter == 1 and lastperson == interaction.user.id:
-                await interaction.response.send_message("the 2nd /pause needs to be ran by someone else :V")
-                return
+        channel_id = interaction.guild.voice_client.channel.id
+        if interaction.user.id in admins:
+            votes.reset(channel_id, "pause")
+            await interaction.response.send_message("[admin override applied] pausing the bot, use /resume to keep playing the queue")
+        else:
+            match votes.cast(channel_id, "pause", interaction.user.id):
+                case ("passed", _, _):
+                    await interaction.response.send_message("pausing the bot, use /resume to keep playing the queue")
+                case ("voted", count, needed):
+                    await interaction.response.send_message(vote_message("pause", count, needed))
+                    return
+                case ("already", _, _):
+                    await interaction.response.send_message("you already voted, the next /pause needs to be ran by someone else :V")
+                    return
+                case ("done", _, _):
+                    await interaction.response.send_message("already pausing the bot :3", ephemeral=True)
+                    return
 
         # Clean up librespot process
         if interaction.guild.voice_client.source:
             interaction.guild.voice_client.source.cleanup()
         await interaction.guild.voice_client.disconnect()
-        await interaction.response.send_message("paused spotify, use /resume to start from where ya left off.", ephemeral=True)
+        forget_session(interaction.guild.id)
+        await interaction.followup.send("paused spotify, use /resume to start from where ya left off.", ephemeral=True)
         #await shutdown_bot()
     else:
         await interaction.response.send_message("brotha i'm not in a vc.", ephemeral=True)
@@ -409,10 +1303,16 @@ async def queue(interaction: discord.Interaction):
         await interaction.response.send_message("you're in the wrong vc, or the bot is playing in another server.", ephemeral=True)
         return
     if interaction.guild.voice_client:
-        queue = get_queue()
-        if queue != None:
-            await interaction.response.send_message(f"""Queue (first song is currently playing):
-{yaml.dump(queue)}""", ephemeral=True)
+        # answer from the cached render if we have one, instead of asking spotify again every time
+        status = get_now_playing(interaction.guild.id)
+        if status.text is None or status.stale:
+            queue = get_queue()
+            status.text = render_queue(queue) if queue != None else None
+            status.stale = False
+            status.schedule_edit()
+        status.attach(interaction.channel)
+        if status.text != None:
+            await interaction.response.send_message(status.text, ephemeral=True)
         else:
             await interaction.response.send_message(f"seems like the queue is empty, or the spotify library had an issue.", ephemeral=True)
     else:
@@ -434,8 +1334,6 @@ async def resume(interaction: discord.Interaction):
     channel = interaction.user.voice.channel
     vc = await channel.connect()
 
-    librespot = LibrespotAudio()
-    await librespot.start()
     # the other audio handler, might work better? idfk tho
     #source = discord.FFmpegPCMAudio(
     #    librespot,
@@ -443,18 +1341,14 @@ async def resume(interaction: discord.Interaction):
     #    before_options='-rtbufsize 150000 -f s16le -ar 48000 -ac 2',  # 176400 = 44100 * 2 * 2 (1 second of s16 stereo at 44.1kHz)
     #    options='-vn -vbr 0 -bufsize 150000'
     #) q
-    source = discord.PCMAudio(
-        librespot
-    )
-    vc.play(source)
-    asyncio.create_task(monitor_playback_and_disconnect(vc))
-    
+    await start_audio(vc)
+
     await interaction.response.send_message("firing up librespot and requesting spotify to start playback..", ephemeral=True)
     device_found = False
     while not device_found:
         devices = sp.devices()
         for d in devices['devices']:
-            print(f"{d['name']}: {d['id']}")
+            spotify_log.debug("Found device %s: %s", d['name'], d['id'])
             if d['name'] == "Discord Bot":
                 try:
                     sp.transfer_playback(device_id=d['id'], force_play=True)
@@ -462,10 +1356,33 @@ async def resume(interaction: discord.Interaction):
                     await asyncio.sleep(3)
                     await interaction.edit_original_response(content="spotify seems to be playing now, if not, use /shutdown and try again.")
                 except Exception as e:
-                    print(e)
+                    spotify_log.error("Error transferring playback: %s", e)
                     await interaction.edit_original_response(content=f"an error occurred{e}, try using /shutdown and then using /play again after 10 seconds.")
                     pass
 
+@tree.command(name="volume", description="Change the bot's volume, works instantly", )
+@app_commands.describe(
+    volume="Volume in percent (100 is normal)",
+    normalize="Even out the loudness between tracks"
+)
+async def volume(interaction: discord.Interaction, volume: app_commands.Range[int, 0, 200], normalize: bool = None):
+    if not interaction.user.voice:
+        await interaction.response.send_message("brotha join a vc first", ephemeral=True)
+        return
+    if not interaction.guild.voice_client:
+        await interaction.response.send_message("brotha i'm not even in the vc, use /resume or /play first.", ephemeral=True)
+        return
+    if interaction.guild.voice_client.channel.id != interaction.user.voice.channel.id:
+        await interaction.response.send_message("you're in the wrong vc, or the bot is playing in another server.", ephemeral=True)
+        return
+
+    gain = get_gain_stage(interaction.guild.id)
+    gain.set_volume(volume / 100)
+    if normalize is not None:
+        gain.set_normalize(normalize)
+    store.set(f"volume:{interaction.guild.id}", {'volume': gain.volume, 'normalize': gain.normalize})
+    await interaction.response.send_message(f"volume set to {volume}%" + (", normalization on" if gain.normalize else ""))
+
 @tree.command(name="search", description="Search for a song on Spotify", )
 async def search(interaction: discord.Interaction, query: str):
     if not sp:
@@ -505,28 +1422,23 @@ async def skip(interaction: discord.Interaction):
         await interaction.response.send_message("you're in the wrong vc, or the bot is playing in another server.", ephemeral=True)
         return
 
-    # The two-party verification, to avoid trolls and other assorted people doing evil things
-    global personskipcounter, lastperson
-    match personskipcounter:
-        case _ if interaction.user.id in admins:
-            personskipcounter = 0
-            sp.next_track()
-            await interaction.response.send_message("[admin override applied] skipped to the next track :3")
-            return
-        case _ if personskipcounter == 0:
-            personskipcounter += 1
-            lastperson = interaction.user.id
-            await interaction.response.send_message("voted to skip, but 1 more person needs to also run /skip.")
-            return
-        case _ if personskipcounter == 1 and lastperson != interaction.user.id:
-            personskipcounter = 0
-            lastperson = None
+    # The vote, to avoid trolls and other assorted people doing evil things
+    channel_id = interaction.guild.voice_client.channel.id
+    if interaction.user.id in admins:
+        votes.reset(channel_id, "skip")
+        sp.next_track()
+        await interaction.response.send_message("[admin override applied] skipped to the next track :3")
+        return
+    match votes.cast(channel_id, "skip", interaction.user.id):
+        case ("passed", _, _):
             sp.next_track()
             await interaction.response.send_message("skipped to the next track :3")
-            return
-        case _ if personskipcounter == 1 and lastperson == interaction.user.id:
-            await interaction.response.send_message("the 2nd /skip needs to be ran by someone else :V")
-            return
+        case ("voted", count, needed):
+            await interaction.response.send_message(vote_message("skip", count, needed))
+        case ("already", _, _):
+            await interaction.response.send_message("you already voted, the next /skip needs to be ran by someone else :V")
+        case ("done", _, _):
+            await interaction.response.send_message("already skipped :3", ephemeral=True)
 
 
 @tree.command(name="radio", description="Start a Spotify radio based on a track or artist", )
@@ -565,7 +1477,7 @@ async def radio(interaction: discord.Interaction, query: str):
         sp.start_playback(uris=[first_uri])
         # Queue the rest
         for track in recs['tracks'][1:]:
-            sp.add_to_queue(track['uri'])
+            queue_track(interaction.guild.id, track['uri'])
         track_names = [f"{t['name']} by {t['artists'][0]['name']}" for t in recs['tracks']]
         await interaction.response.send_message(f"Started radio!\nQueued:\n" + "\n".join(track_names), ephemeral=True)
     except Exception as e:
@@ -590,37 +1502,29 @@ async def url(interaction: discord.Interaction, url: str):
         channel = interaction.user.voice.channel
         vc = await channel.connect()
 
-        librespot = LibrespotAudio()
-        await librespot.start()
-        source = discord.PCMAudio(
-            librespot
-        )
-        vc.play(source)
-        asyncio.create_task(monitor_playback_and_disconnect(vc))
+        await start_audio(vc)
 
         await interaction.response.send_message("firing up librespot...", ephemeral=True)
         device_found = False
         await asyncio.sleep(2)
         try:
             sp.transfer_playback(device_id="3d66146a7408d60061ddebcd66f5cb098dcec1c8", force_play=True)
-            sp.volume(100)
             device_found = True
             await asyncio.sleep(2)
         except Exception as e:
-            print(e)
+            spotify_log.error("Error transferring playback: %s", e)
             pass
         while not device_found:
             devices = sp.devices()
             for d in devices['devices']:
-                print(f"{d['name']}: {d['id']}")
+                spotify_log.debug("Found device %s: %s", d['name'], d['id'])
                 if d['name'] == "Discord Bot":
                     try:
                         sp.transfer_playback(device_id=d['id'], force_play=True)
-                        sp.volume(100)
                         device_found = True
                         await asyncio.sleep(2)
                     except Exception as e:
-                        print(e)
+                        spotify_log.error("Error transferring playback: %s", e)
                         pass
 
 
@@ -658,11 +1562,11 @@ async def url(interaction: discord.Interaction, url: str):
             try:
                 sp.current_user_saved_tracks_add(tracks=[track['id']])
             except Exception as e:
-                print(f"Error adding track to liked songs: {e}")
+                spotify_log.error("Error adding track to liked songs: %s", e)
 
             if await is_spotify_playing():
                 # Add to queue
-                sp.add_to_queue(track_uri)
+                queue_track(interaction.guild.id, track_uri)
                 await interaction.edit_original_response(content=f"added {track['name']} by {track['artists'][0]['name']} to the queue.")
             else:
                 # Start playback
@@ -688,18 +1592,18 @@ async def url(interaction: discord.Interaction, url: str):
                     chunk = track_ids[i:i + chunk_size]
                     sp.current_user_saved_tracks_add(tracks=chunk)
             except Exception as e:
-                print(f"Error adding album tracks to liked songs: {e}")
+                spotify_log.error("Error adding album tracks to liked songs: %s", e)
 
             if await is_spotify_playing():
                 # Add all tracks to queue
                 for uri in track_uris:
-                    sp.add_to_queue(uri)
+                    queue_track(interaction.guild.id, uri)
                 await interaction.edit_original_response(content=f"added album to queue: {album['name']} by {album['artists'][0]['name']}\n({len(track_uris)} tracks)")
             else:
                 # Start playback with first track and queue the rest
                 sp.start_playback(uris=[track_uris[0]])
                 for uri in track_uris[1:]:
-                    sp.add_to_queue(uri)
+                    queue_track(interaction.guild.id, uri)
                 await interaction.edit_original_response(content=f"now playing album: {album['name']} by {album['artists'][0]['name']}\n({len(track_uris)} tracks)")
 
         elif content_type == 'playlist':
@@ -729,25 +1633,25 @@ async def url(interaction: discord.Interaction, url: str):
                     chunk = track_ids[i:i + chunk_size]
                     sp.current_user_saved_tracks_add(tracks=chunk)
             except Exception as e:
-                print(f"Error adding playlist tracks to liked songs: {e}")
+                spotify_log.error("Error adding playlist tracks to liked songs: %s", e)
 
             if await is_spotify_playing():
                 # Add all tracks to queue
                 for uri in track_uris:
-                    sp.add_to_queue(uri)
+                    queue_track(interaction.guild.id, uri)
                 await interaction.edit_original_response(content=f"added playlist to queue: {playlist['name']}\n({len(track_uris)} tracks)")
             else:
                 # Start playback with first track and queue the rest
                 sp.start_playback(uris=[track_uris[0]])
                 for uri in track_uris[1:]:
-                    sp.add_to_queue(uri)
+                    queue_track(interaction.guild.id, uri)
                 await interaction.edit_original_response(content=f"now playing playlist: {playlist['name']}\n({len(track_uris)} tracks)")
 
         else:
             await interaction.edit_original_response(content="unsupported content type, please only play albums, tracks, or playlists.")
 
     except Exception as e:
-        print(f"Error playing from URL: {e}")
+        log.error("Error playing from URL: %s", e)
         await interaction.edit_original_response(content=f"something went wrong :/ - {str(e)}")
 
 @tree.command(name="stop", description="Stop playback and clear the queue", )
@@ -772,13 +1676,14 @@ async def stop(interaction: discord.Interaction):
         # Note: Spotify API doesn't have a direct "clear queue" endpoint,
         # so we start a new empty queue to effectively clear it
         sp.start_playback(uris=[])
+        enqueued_tracks.pop(interaction.guild.id, None)
         
         await interaction.response.send_message("cleared the queue")
     except Exception as e:
         await interaction.response.send_message(f"Error stopping playback: {str(e)}", ephemeral=True)
 
 async def shutdown_bot():
-    print("Shutting down bot...")
+    log.info("Shutting down bot...")
 
     # Terminate any librespot processes from active voice clients
     for vc in bot.voice_clients:
@@ -788,55 +1693,223 @@ async def shutdown_bot():
                     vc.source.cleanup()
                 await vc.disconnect()
             except Exception as e:
-                print(f"Error disconnecting voice client: {e}")
+                log.error("Error disconnecting voice client: %s", e)
 
     # Optionally, stop playback on Spotify (just in case)
     try:
         if sp:
             sp.pause_playback()
     except Exception as e:
-        print(f"Failed to pause playback: {e}")
+        spotify_log.error("Failed to pause playback: %s", e)
 
     # Stop the bot gracefully
     try:
         os.system("pkill librespot")
     except Exception as e:
-        print(f"Failed to kill librespot processes: {e}")
+        log.error("Failed to kill librespot processes: %s", e)
 
     try:
         await bot.close()
     except Exception as e:
-        print(f"Failed to close bot: {e}")
+        log.error("Failed to close bot: %s", e)
 
 
 @tree.command(name="shutdown", description="Force the bot to restart (to fix a bug), please don't abuse this command.")
 async def shutdown(interaction: discord.Interaction):
-    global personshutdowncounter, lastperson
-    match personshutdowncounter:
-        case _ if interaction.user.id in admins:
-            personshutdowncounter = 0
-            await interaction.response.send_message("[admin override applied] shutting the bot down")
-        case _ if personshutdowncounter == 0:
-            personshutdowncounter += 1
-            lastperson = interaction.user.id
-            await interaction.response.send_message("voted to shutdown, but 1 more person needs to also run /shutdown.")
-            return
-        case _ if personshutdowncounter == 1 and lastperson != interaction.user.id:
-            personshutdowncounter = 0
-            lastperson = None
-            await interaction.response.send_message("shutting the bot down")
-        case _ if personshutdowncounter == 1 and lastperson == interaction.user.id:
-            await interaction.response.send_message("the 2nd /shutdown needs to be ran by someone else :V")
-            return
-    await interaction.response.send_message("Shutting down...", ephemeral=True)
+    # vote in the bot's vc if it's in one, otherwise just count per server like before
+    if interaction.guild.voice_client:
+        channel_id = interaction.guild.voice_client.channel.id
+    else:
+        channel_id = interaction.guild.id
+    if interaction.user.id in admins:
+        votes.reset(channel_id, "shutdown")
+        await interaction.response.send_message("[admin override applied] shutting the bot down")
+    else:
+        match votes.cast(channel_id, "shutdown", interaction.user.id):
+            case ("passed", _, _):
+                await interaction.response.send_message("shutting the bot down")
+            case ("voted", count, needed):
+                await interaction.response.send_message(vote_message("shutdown", count, needed))
+                return
+            case ("already", _, _):
+                await interaction.response.send_message("you already voted, the next /shutdown needs to be ran by someone else :V")
+                return
+            case ("done", _, _):
+                await interaction.response.send_message("already shutting the bot down", ephemeral=True)
+                return
+    await interaction.followup.send("Shutting down...", ephemeral=True)
     await shutdown_bot()
 
 
 
+@bot.event
+async def on_guild_channel_update(before, after):
+    """
+    Re-picks the audio quality when someone changes the bitrate of the channel we're playing in.
+    """
+    vc = after.guild.voice_client
+    if not vc or not vc.channel or vc.channel.id != after.id:
+        return
+    if getattr(before, 'bitrate', None) == getattr(after, 'bitrate', None):
+        return
+    profile = pick_audio_profile(after.bitrate)
+    audio_log.info("Channel bitrate changed to %skbps, switched to %s quality", after.bitrate // 1000, profile['name'], extra={'guild': after.guild.id})
+    librespot = getattr(vc.source, 'stream', None)
+    if not isinstance(librespot, LibrespotAudio):
+        return
+    if librespot.profile['librespot_bitrate'] == profile['librespot_bitrate']:
+        # same librespot bitrate, the player thread just retunes the encoder before its next frame
+        librespot.request_tuning(vc, profile)
+    else:
+        # librespot can't change bitrate while it's running, so swap in one at the new bitrate
+        try:
+            await hot_swap_audio(vc, f"librespot bitrate now {profile['librespot_bitrate']}kbps", profile, force_play=await is_librespot_playing())
+        except Exception as e:
+            # the watchdog will pick up the half swapped pipeline and retry
+            audio_log.error("Error restarting librespot at the new bitrate: %s", e, extra={'guild': after.guild.id})
+
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    if member.id == bot.user.id:
+        if before.channel and before.channel != after.channel:
+            votes.forget_channel(before.channel.id)
+        if after.channel and before.channel != after.channel:
+            votes.track_channel(after.channel)
+    else:
+        votes.member_moved(member, before.channel, after.channel)
+    # however we left the vc (/leave, /pause, /shutdown, getting kicked), let the other workers have a go
+    if member.id == bot.user.id and before.channel and not after.channel:
+        await asyncio.to_thread(release_voice_session, before.channel.guild.id)
+        now_playing.pop(before.channel.guild.id, None)
+        latest_playback.pop(before.channel.guild.id, None)
+
+
+@tasks.loop(seconds=30)
+async def report_load():
+    """
+    Writes how many guilds each of our shards has into the state store, the coordinator uses it to balance workers.
+    """
+    shard_guilds = {}
+    for guild in bot.guilds:
+        shard_guilds[guild.shard_id] = shard_guilds.get(guild.shard_id, 0) + 1
+    worker = {
+        'shards': sorted(shard_guilds),
+        'guilds': len(bot.guilds),
+        'voice_clients': len(bot.voice_clients),
+        'heartbeat': time.time(),
+    }
+
+    def write():
+        for shard_id, count in shard_guilds.items():
+            store.set(f"shard_load:{shard_id}", count)
+        store.set(f"worker:{WORKER_ID}", worker)
+
+    # sqlite commits can wait on disk, keep them off the event loop
+    await asyncio.to_thread(write)
+
+
+sessions_restored = False
+
 @bot.event
 async def on_ready():
+    global sessions_restored
     await tree.sync()
-    print(f"Logged in as {bot.user}")
+    if not report_load.is_running():
+        report_load.start()
+    log.info("Logged in as %s", bot.user)
+    # on_ready fires again after reconnects, only pick up old sessions on the first one
+    if not sessions_restored:
+        sessions_restored = True
+        await restore_sessions()
+
 
-bot.run(TOKEN)
+def assign_shards(shard_count, workers, shard_load):
+    """
+    Spreads the shards over the workers, heaviest shards first, each going to whichever worker has the fewest guilds so far.
+    """
+    assignments = [[] for _ in range(workers)]
+    totals = [0] * workers
+    for shard_id in sorted(range(shard_count), key=lambda s: shard_load.get(s, 0), reverse=True):
+        worker = totals.index(min(totals))
+        assignments[worker].append(shard_id)
+        # unknown shards still count for something, so they don't all land on one worker
+        totals[worker] += shard_load.get(shard_id, 1)
+    return [sorted(shards) for shards in assignments if shards]
+
+
+def read_shard_load():
+    """returns {shard id: guild count} as last reported by the workers."""
+    return {int(key.split(':', 1)[1]): count for key, count in store.items('shard_load:').items()}
+
+
+def assignment_imbalance(assignments, shard_load):
+    """how many times more guilds the busiest worker has than the quietest one."""
+    totals = [sum(shard_load.get(shard_id, 1) for shard_id in shards) for shards in assignments]
+    return max(totals) / max(min(totals), 1)
+
+
+def run_coordinator():
+    """
+    Starts one bot process per worker, each running its share of the shards, and restarts any that die.
+    Every so often it re-reads the shard load and rebalances if the workers have drifted too far apart.
+    """
+    workers = int(os.getenv('WORKERS', str(os.cpu_count() or 1)))
+    shard_count = SHARD_COUNT or workers
+
+    def spawn(worker_id, shards):
+        env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=','.join(map(str, shards)), WORKER_ID=str(worker_id))
+        shard_log.info("Starting worker %s with shards %s", worker_id, shards)
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    def spawn_all(assignments):
+        return {worker_id: spawn(worker_id, shards) for worker_id, shards in enumerate(assignments)}
+
+    def stop_all(processes):
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    # on the very first run nobody has reported load yet, so this starts out as an even split
+    assignments = assign_shards(shard_count, workers, read_shard_load())
+    processes = spawn_all(assignments)
+    last_rebalance = time.monotonic()
+    try:
+        while True:
+            time.sleep(5)
+            dead = [worker_id for worker_id, process in processes.items() if process.poll() is not None]
+            due = time.monotonic() - last_rebalance > REBALANCE_INTERVAL
+            if not dead and not due:
+                continue
+
+            shard_load = read_shard_load()
+            balanced = assign_shards(shard_count, workers, shard_load)
+            last_rebalance = time.monotonic()
+            # moving shards restarts every worker, so only do it when it's worth it, and never mid song
+            claim = store.get('voice_session')
+            playing = claim and time.time() - claim['heartbeat'] < VOICE_CLAIM_TTL
+            if balanced != assignments and not playing and (dead or assignment_imbalance(assignments, shard_load) > REBALANCE_THRESHOLD):
+                shard_log.info("Rebalancing shards over the workers: %s", balanced)
+                stop_all(processes)
+                assignments = balanced
+                processes = spawn_all(assignments)
+                continue
+            for worker_id in dead:
+                shard_log.warning("Worker %s exited with code %s, restarting it", worker_id, processes[worker_id].returncode)
+                processes[worker_id] = spawn(worker_id, assignments[worker_id])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_all(processes)
+
+
+if "--coordinator" in sys.argv:
+    run_coordinator()
+else:
+    # logging is already set up, don't let discord.py add its own handler on top
+    bot.run(TOKEN, log_handler=None)
 